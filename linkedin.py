@@ -2,25 +2,41 @@
 
 import sys
 
-if len(sys.argv) != 5:
+if len(sys.argv) != 5 and not (len(sys.argv) >= 3 and sys.argv[1] in ['extract','bench']) \
+        and not (len(sys.argv) >= 4 and sys.argv[1] == 'replay'):
     print(f'Usage: {sys.argv[0]} <keywords.txt> <locations.txt> <npages> postgresql://[username]:[password]@[host]:[port]/[database]')
+    print(f'       {sys.argv[0]} extract <job.html>...')
+    print(f'       {sys.argv[0]} bench <job.html>...')
+    print(f'       {sys.argv[0]} replay postgresql://[username]:[password]@[host]:[port]/[database] <job.html>...')
     sys.exit(1)
 
 import psycopg
 from tqdm import trange, tqdm
 import traceback
+import contextlib
 import os
 import csv
+import html
+import json
 import time
 import random
+import tempfile
+import threading
 import warnings
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import lxml.etree
+import lxml.html
+import urllib3
 import pandas as pd
 from selenium import webdriver
-from urllib.parse import urljoin, urlparse
+from urllib.parse import parse_qs, urlencode, urljoin, urlparse
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.support.ui import WebDriverWait
-from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import NoSuchElementException, TimeoutException
 from selenium.webdriver.support import expected_conditions as EC
 import re
 from selenium.webdriver.chrome.service import Service as ChromeService
@@ -30,104 +46,611 @@ from webdriver_manager.chrome import ChromeDriverManager
 from selenium.webdriver.common.action_chains import ActionChains
 warnings.filterwarnings('ignore')
 
-def the_browser():
-    service = ChromeService(ChromeDriverManager().install())
-    driver = webdriver.Chrome(service=service)
+# Per-stage timings (names ending in _s) and counters, reported when the
+# scraper exits.  With JB_METRICS set, every sample is also appended to that
+# file as a JSON line, followed by a summary line per run.
+stats = {}
+stats_lock = threading.Lock()
+metrics_path = os.environ.get('JB_METRICS', '')
+metrics = open(metrics_path, 'a', buffering=1) if metrics_path else None
+
+def record(name, value=1):
+    with stats_lock:
+        total, count = stats.get(name, (0, 0))
+        stats[name] = (total + value, count + 1)
+        if metrics:
+            metrics.write(json.dumps({'ts': time.time(), 'metric': name, 'value': value}) + '\n')
+
+@contextlib.contextmanager
+def timed(stage):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record(f'{stage}_s', time.monotonic() - start)
+
+def report(elapsed=None):
+    with stats_lock:
+        for name, (total, count) in sorted(stats.items()):
+            print(f'{name:>14}: {count:6} x {total / max(1, count):10.3f} (total {total:.1f})')
+        if elapsed:
+            jobs = stats.get('jobs_written', (0, 0))[0]
+            print(f'{jobs} jobs in {elapsed:.1f}s: {3600 * jobs / elapsed:.0f} jobs/hour')
+            if metrics:
+                metrics.write(json.dumps({'ts': time.time(), 'metric': 'summary', 'elapsed_s': elapsed,
+                                          'jobs_per_hour': 3600 * jobs / elapsed,
+                                          'stats': {k: {'total': t, 'count': c} for k, (t, c) in stats.items()}}) + '\n')
+
+#__________________________________________________________________________________________________________________________#
+
+lean = os.environ.get('JB_LEAN', '1') != '0'
+
+# Images, fonts, media and trackers are never needed to read a job page.
+BLOCKED_URLS = [
+    '*.png', '*.jpg', '*.jpeg', '*.gif', '*.webp', '*.svg', '*.ico',
+    '*.woff', '*.woff2', '*.ttf', '*.otf',
+    '*.mp4', '*.webm', '*.mp3', '*.m3u8',
+    '*media.licdn.com*', '*px.ads.linkedin.com*', '*snap.licdn.com*', '*linkedin.com/li/track*',
+    '*doubleclick.net*', '*google-analytics.com*', '*googletagmanager.com*', '*facebook.net*',
+]
+
+# CHROMEDRIVER pins the driver; otherwise webdriver_manager is asked once per
+# process, and if it cannot reach the network Selenium looks for a cached one.
+driver_path = os.environ.get('CHROMEDRIVER')
+driver_lock = threading.Lock()
+
+def the_driver():
+    global driver_path
+    with driver_lock:
+        if driver_path is None:
+            try:
+                driver_path = ChromeDriverManager().install()
+            except Exception as e:
+                print(f'webdriver_manager failed ({e}), falling back to Selenium Manager')
+                driver_path = ''
+        return driver_path
+
+def the_browser(profile):
+    t = time.monotonic()
+    service = ChromeService(the_driver() or None)
+    options = Options()
+    options.add_argument(f'--user-data-dir={profile}')
+    options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+    if lean:
+        options.add_argument('--headless=new')
+        options.add_argument('--window-size=1920,1080')
+        options.add_argument('--blink-settings=imagesEnabled=false')
+        options.add_argument('--mute-audio')
+        options.add_argument('--no-first-run')
+        options.add_argument('--disable-extensions')
+        options.add_argument('--disable-background-networking')
+    driver = webdriver.Chrome(service=service, options=options)
+    if lean:
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': BLOCKED_URLS})
+    else:
+        driver.maximize_window()
+    record('startup_s', time.monotonic() - t)
     return driver 
 
+# A throwaway Chrome profile, removed once the browser using it has quit.
+def scratch_profile():
+    return tempfile.TemporaryDirectory(prefix='jb-chrome-', ignore_cleanup_errors=True)
+
+# Bytes received since the last call, summed over the DevTools
+# Network.loadingFinished events in the performance log.  Unlike the
+# Performance API's transferSize this also counts cross-origin resources
+# served without Timing-Allow-Origin, i.e. most of static.licdn.com.
+def page_bytes(browser):
+    size = 0
+    for entry in browser.get_log('performance'):
+        message = json.loads(entry['message'])['message']
+        if message['method'] == 'Network.loadingFinished':
+            size += message['params']['encodedDataLength']
+    return size
+
+# Load time (ms) of the current page, from the Performance API.
+def page_load(browser):
+    return browser.execute_script(
+        "const nav = performance.getEntriesByType('navigation')[0];"
+        "return nav && nav.loadEventEnd > 0 ? nav.loadEventEnd : performance.now();")
+
+# Call before loading a page so that record_page() counts only that page.
+def start_page(browser):
+    with contextlib.suppress(Exception):
+        page_bytes(browser)
+
+def record_page(browser):
+    try:
+        size, load = page_bytes(browser), page_load(browser)
+    except Exception:
+        return
+    record('page_kb', size / 1024)
+    record('page_load_ms', load)
+
+#__________________________________________________________________________________________________________________________#
+
+# Spaces out the page loads of all sessions, replacing the per-process pauses.
+# The spacing backs off multiplicatively whenever a session sees a sign-in wall
+# or throttling page, and creeps back to the configured rate on clean loads.
+class RateLimiter():
+    def __init__(self,per_minute,max_backoff=32):
+        self.interval = 60 / per_minute
+        self.max_backoff = max_backoff
+        self.backoff = 1
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next - now
+            self.next = max(now, self.next) + self.interval * self.backoff * random.uniform(0.5, 1.5)
+        if wait > 0:
+            record('pace_wait_s', wait)
+            time.sleep(wait)
+
+    def slow_down(self):
+        with self.lock:
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            self.next = max(self.next, time.monotonic() + self.interval * self.backoff)
+            print(f'throttled, pacing at {self.interval * self.backoff:.1f}s per page')
+        record('pauses')
+
+    def speed_up(self):
+        with self.lock:
+            self.backoff = max(1, self.backoff * 0.9)
+
+#__________________________________________________________________________________________________________________________#
+
+# Work shared by all sessions: (keyword, location) searches and the job pages
+# they turn up.  Job pages go first so that links are scraped while fresh.
+# With the HTTP fast path on, job pages are queued for the fetchers first and
+# only reach the browsers through fallback().
+# get() returns None once everything is done and no session can add more,
+# once the browser sessions are gone and nothing is left for the fetchers, or
+# as soon as stop() is called.
+#
+# When given a connection, the frontier is also kept in Postgres: pending job
+# pages live in scrape_pending until they are written or dropped, and finished
+# searches are stamped in scrape_searches, so a restarted scraper resumes
+# instead of repeating every search.
+class Frontier():
+    def __init__(self,conn=None,fast=False,sessions=1):
+        self.conn = conn
+        self.cond = threading.Condition()
+        self.queues = {'fetch': deque(), 'job': deque(), 'search': deque()}
+        self.fast = fast
+        self.sessions = sessions
+        self.seen = set()
+        self.active = 0
+        self.stopped = False
+        self.tries = {}
+
+    def setup(self):
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS scrape_pending (
+                job_link text PRIMARY KEY,
+                searched_keyword text,
+                ctime timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP)""")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS scrape_searches (
+                keyword text,
+                location text,
+                done timestamptz,
+                PRIMARY KEY (keyword, location))""")
+
+    # Queues the searches not finished within the last interval hours, and
+    # every job page left over from an earlier run.
+    def load(self,keywords,locations,interval):
+        pairs = [(key,loc) for loc in locations for key in keywords]
+        if self.conn is None:
+            for key,loc in pairs:
+                self.add_search(key,loc)
+            return
+        self.setup()
+        with self.conn.cursor() as cur:
+            cur.executemany("INSERT INTO scrape_searches (keyword, location) VALUES (%s, %s) ON CONFLICT DO NOTHING", pairs)
+            cur.execute("SELECT keyword, location FROM scrape_searches WHERE done > CURRENT_TIMESTAMP - %s * interval '1 hour'", (interval,))
+            recent = set(cur.fetchall())
+            for key,loc in pairs:
+                if (key,loc) not in recent:
+                    self.add_search(key,loc)
+            cur.execute("SELECT job_link, searched_keyword FROM scrape_pending ORDER BY ctime")
+            pending = cur.fetchall()
+        with self.cond:
+            for url,key in pending:
+                self.seen.add(url)
+                self.queues['fetch' if self.fast else 'job'].append((url,key))
+        print(f'{len(self.queues["search"])} searches, {len(pending)} pending jobs, {len(recent)} searches done recently')
+
+    def add_search(self,key,loc):
+        with self.cond:
+            self.queues['search'].append((key,loc))
+            self.cond.notify_all()
+
+    def add_jobs(self,urls,key):
+        with self.cond:
+            urls = [url for url in urls if url not in self.seen]
+            self.seen.update(urls)
+        if not urls:
+            return
+        if self.conn is not None:
+            with self.conn.cursor() as cur:
+                cur.executemany("INSERT INTO scrape_pending (job_link, searched_keyword) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                                [(url,key) for url in urls])
+        with self.cond:
+            self.queues['fetch' if self.fast else 'job'].extend((url,key) for url in urls)
+            self.cond.notify_all()
+
+    def fallback(self,url,key):
+        with self.cond:
+            self.queues['job'].append((url,key))
+            self.cond.notify_all()
+
+    # Puts a page that hit the throttling wall back at the end of the job
+    # queue, at most limit times; after that it waits in scrape_pending.
+    def retry(self,url,key,limit):
+        with self.cond:
+            self.tries[url] = self.tries.get(url, 0) + 1
+            if self.tries[url] > limit:
+                return False
+            self.queues['job'].append((url,key))
+            self.cond.notify_all()
+            return True
+
+    def search_done(self,key,loc):
+        if self.conn is not None:
+            self.conn.execute("UPDATE scrape_searches SET done = CURRENT_TIMESTAMP WHERE keyword = %s AND location = %s", (key,loc))
+
+    # Gives up on a job page; written pages are removed by the JobWriter.
+    def drop(self,url):
+        if self.conn is not None:
+            self.conn.execute("DELETE FROM scrape_pending WHERE job_link = %s", (url,))
+
+    def get(self,kinds=('job','search')):
+        with self.cond:
+            while not self.stopped and not any(self.queues[k] for k in kinds):
+                served = ['fetch', 'job', 'search'] if self.sessions > 0 else ['fetch']
+                if self.active == 0 and not any(self.queues[k] for k in served):
+                    self.cond.notify_all()
+                    return None
+                self.cond.wait()
+            if self.stopped:
+                return None
+            self.active += 1
+            kind = next(k for k in kinds if self.queues[k])
+            return (kind,) + self.queues[kind].popleft()
+
+    def done(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    # Workers finish the page in hand and take no more; what is left stays in
+    # scrape_pending for the next run.
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    # A browser session stopped, for good or because Chrome failed.
+    def leave(self):
+        with self.cond:
+            self.sessions -= 1
+            self.cond.notify_all()
+
+    def pending(self):
+        with self.cond:
+            return {k: len(q) for k, q in self.queues.items()}
+
 #__________________________________________________________________________________________________________________________#
 
-base_url = 'https://www.linkedin.com/jobs/search/?position=1&pageNum=0'
+base_url = os.environ.get('JB_BASE_URL', 'https://www.linkedin.com') + '/jobs/search/?position=1&pageNum=0'
+
+#___________________________________________________________________________________________________________________________#
+
+# Reads every field of a job page in a single WebDriver round trip.
+# Fields that are absent come back as null rather than failing the whole page.
+EXTRACT_JS = '''
+const text = s => { const e = document.querySelector(s); return e ? e.innerText.trim() : null; };
+const desc = document.querySelector('div.show-more-less-html__markup');
+const job = {
+    job_title: text('h2.top-card-layout__title, h1.top-card-layout__title'),
+    job_description: desc ? desc.innerHTML : null,
+    organization_name: text('a.topcard__org-name-link.topcard__flavor--black-link'),
+    location: text('span.topcard__flavor.topcard__flavor--bullet'),
+};
+const criteria = {};
+for (const li of document.querySelectorAll('.description__job-criteria-item')) {
+    const h = li.querySelector('.description__job-criteria-subheader');
+    const v = li.querySelector('.description__job-criteria-text');
+    if (h && v)
+        criteria[h.innerText.trim().toLowerCase()] = v.innerText.trim();
+}
+return [job, criteria];
+'''
+
+EXTRACT_FIELDS = ['job_title', 'job_description', 'organization_name', 'location']
+REQUIRED_FIELDS = ['job_title', 'job_description']
+
+key_mapping = {"seniority level" : "seniority_level",
+               "employment type" : "employment_type", "job function":"job_function"}
+
+def finish_extract(job, criteria):
+    missing = [k for k in EXTRACT_FIELDS if not job[k]]
+    job_dict = {k: v for k, v in job.items() if v}
+    for k, v in criteria.items():
+        job_dict[key_mapping.get(k, k)] = v
+    return job_dict, missing
+
+# Returns the job fields found on the current page and the names of those missing.
+def extract_job(browser):
+    return finish_extract(*browser.execute_script(EXTRACT_JS))
+
+# The same extraction over server-rendered HTML, without a browser.
+def has_class(*names):
+    return ' and '.join(f"contains(concat(' ', normalize-space(@class), ' '), ' {n} ')" for n in names)
+
+def first(node, xpath):
+    found = node.xpath(xpath)
+    return found[0] if found else None
+
+def text_of(node):
+    return ' '.join(node.text_content().split()) if node is not None else None
+
+def inner_html(node):
+    if node is None:
+        return None
+    return html.escape(node.text or '', quote=False) + ''.join(lxml.html.tostring(c, encoding='unicode') for c in node)
+
+def extract_html(page):
+    doc = lxml.html.fromstring(page)
+    job = {
+        'job_title': text_of(first(doc, f"//*[self::h1 or self::h2][{has_class('top-card-layout__title')}]")),
+        'job_description': inner_html(first(doc, f"//div[{has_class('show-more-less-html__markup')}]")),
+        'organization_name': text_of(first(doc, f"//a[{has_class('topcard__org-name-link', 'topcard__flavor--black-link')}]")),
+        'location': text_of(first(doc, f"//span[{has_class('topcard__flavor', 'topcard__flavor--bullet')}]")),
+    }
+    criteria = {}
+    for li in doc.xpath(f"//*[{has_class('description__job-criteria-item')}]"):
+        h = text_of(first(li, f".//*[{has_class('description__job-criteria-subheader')}]"))
+        v = text_of(first(li, f".//*[{has_class('description__job-criteria-text')}]"))
+        if h and v:
+            criteria[h.lower()] = v
+    return finish_extract(job, criteria)
+
+def stamp(job_dict, job_link, key_words):
+    job_dict["job_link"] = urljoin(job_link, urlparse(job_link).path)
+    job_dict["source"] = "linkedin"
+    job_dict['searched_keyword'] = key_words
+    return job_dict
+
+#___________________________________________________________________________________________________________________________#
+
+# Scraped jobs are buffered and written in batches: rows with the same set of
+# columns share one executemany.  A batch is written once it has size rows,
+# and a timer writes whatever waited seconds even while every worker is idle.
+# close() flushes whatever is left, so stopping the scraper loses nothing that
+# was already scraped.
+class JobWriter():
+    def __init__(self,conn,size,seconds):
+        self.conn = conn
+        self.size = size
+        self.seconds = seconds
+        self.lock = threading.Lock()
+        self.rows = []
+        self.last = time.monotonic()
+        self.closed = threading.Event()
+        self.timer = threading.Thread(target=self.tick, daemon=True)
+        self.timer.start()
+
+    def add(self,job_data):
+        with self.lock:
+            self.rows.append(job_data)
+            if len(self.rows) >= self.size or time.monotonic() - self.last >= self.seconds:
+                self.flush()
+
+    def tick(self):
+        while not self.closed.wait(max(0.1, self.last + self.seconds - time.monotonic())):
+            with self.lock:
+                if time.monotonic() - self.last < self.seconds:
+                    continue
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"Timed flush failed: {e}")
+
+    def flush(self):
+        self.last = time.monotonic()
+        if not self.rows:
+            return
+        groups = {}
+        for job_data in self.rows:
+            fields = ['applied'] + list(job_data)
+            sql = f"INSERT INTO jobs ({','.join(fields)}) VALUES ({','.join(['%s']*len(fields))}) ON CONFLICT DO NOTHING"
+            groups.setdefault(sql, []).append([False] + list(job_data.values()))
+        with timed('db_write'), self.conn.cursor() as cur:
+            for sql,params in groups.items():
+                try:
+                    with self.conn.transaction():
+                        cur.executemany(sql, params)
+                    record('jobs_written', cur.rowcount)
+                except psycopg.Error as e:
+                    print(f"Batch insert failed, retrying row by row: {e}")
+                    for values in params:
+                        try:
+                            cur.execute(sql, values)
+                            record('jobs_written', cur.rowcount)
+                        except psycopg.Error as e:
+                            print(f"Insert failed for {values[-3]}: {e}")
+            cur.execute("DELETE FROM scrape_pending WHERE job_link = ANY(%s)", ([job_data['job_link'] for job_data in self.rows],))
+        self.rows = []
+        self.last = time.monotonic()
+
+    def close(self):
+        self.closed.set()
+        self.timer.join()
+        with self.lock:
+            self.flush()
+
+#___________________________________________________________________________________________________________________________#
+
+# Public job pages are server-rendered, so most can be read with a plain
+# keep-alive HTTP client.  Anything that comes back incomplete, redirected or
+# throttled is handed to the browsers.
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml',
+    'Accept-Language': 'en-US,en;q=0.9',
+}
+
+def http_pool(threads):
+    return urllib3.PoolManager(maxsize=threads, block=True, headers=HEADERS, retries=False,
+                               timeout=urllib3.Timeout(connect=5, read=15))
+
+# Returns the extracted job, or None if the page has to go through a browser.
+def fetch_job(http, limiter, url):
+    limiter.acquire()
+    try:
+        with timed('http_fetch'):
+            r = http.request('GET', url, redirect=False)
+    except urllib3.exceptions.HTTPError as e:
+        print(f"Fetch failed for {url}: {e}")
+        return None
+    # Like the browsers, treat a bounce to the sign-in wall as throttling.
+    location = r.headers.get('Location', '')
+    if r.status in [429, 999] or 'authwall' in location or 'checkpoint' in location:
+        limiter.slow_down()
+    if r.status != 200:
+        return None
+    try:
+        with timed('extract'):
+            job_dict, missing = extract_html(r.data)
+    except (lxml.etree.LxmlError, ValueError) as e:
+        print(f"Unreadable page at {url}: {e}")
+        return None
+    if any(k in missing for k in REQUIRED_FIELDS):
+        return None
+    limiter.speed_up()
+    return job_dict
+
+class JobFetcher():
+    def __init__(self,writer,frontier,limiter,http):
+        self.writer = writer
+        self.frontier = frontier
+        self.limiter = limiter
+        self.http = http
+
+    def work(self):
+        while (task := self.frontier.get(('fetch',))) is not None:
+            try:
+                _, url, key = task
+                if not self.fetch(url, key):
+                    record('fallbacks')
+                    self.frontier.fallback(url, key)
+            finally:
+                self.frontier.done()
+
+    # A page that fails in any way goes to the browsers; the fetcher carries on.
+    def fetch(self,url,key):
+        try:
+            job_data = fetch_job(self.http, self.limiter, url)
+            if job_data:
+                self.writer.add(stamp(job_data, url, key))
+                return True
+        except Exception as e:
+            print(f"Error while fetching {url}: {e}")
+            traceback.print_tb(e.__traceback__)
+        return False
 
 #___________________________________________________________________________________________________________________________#
 class linked_in_JobScraper():
-    def __init__(self,cur,npages):
+    def __init__(self,cur,writer,npages,frontier,limiter,profile):
         self.cur = cur
+        self.writer = writer
         self.npages = npages
-        self.browser = the_browser()
+        self.frontier = frontier
+        self.limiter = limiter
+        self.browser = the_browser(profile)
         self.links_processed = 0
-        self.links_threshold = random.randint(520,680)
-        self.pause_duration = random.randint(1*60,3*60)
         self.nt_parsed_link = []
         self.job_data_df = pd.DataFrame(columns=["job_title", "job_description", "organization_name", 
                       "location", "department", "key_skills", "seniority_level", 
                       "employment_type", "industries", "job_function", "job_link","source","searched_keyword"])
         self.source = "linkedin"
         self.target_button_class = "infinite-scroller__show-more-button--visible"
+        self.timeout = float(os.environ.get('JB_TIMEOUT', '10'))
+        self.known_run = int(os.environ.get('JB_KNOWN_RUN', '25'))
+        self.throttle_retries = int(os.environ.get('JB_THROTTLE_RETRIES', '3'))
 
-    def touch(self,url):
-        self.cur.execute("UPDATE jobs SET atime = CURRENT_TIMESTAMP WHERE job_link = %s", (url,))
-        cnt = int(self.cur.statusmessage.split(' ')[1])
-        return cnt > 0
+    # Marks the links already in the database as seen and returns them.
+    def touch(self,urls):
+        self.cur.execute("UPDATE jobs SET atime = CURRENT_TIMESTAMP WHERE job_link = ANY(%s) RETURNING job_link", (list(urls),))
+        return {row[0] for row in self.cur.fetchall()}
           
     def job_scrapper(self,job_link,key_words):
-        job_dict = {}
         retries = 0
         max_retries = random.randint(5,8)
-        while retries < max_retries:
+        while True:
+            with timed('extract'):
+                job_dict, missing = extract_job(self.browser)
+            if missing:
+                print(f"Missing {', '.join(missing)} for {job_link}")
+            if not any(k in missing for k in REQUIRED_FIELDS):
+                break
+            self.nt_parsed_link.append(job_link)
+            retries += 1
+            if retries >= max_retries:
+                print(f"Max retries reached for {job_link}. unable to scrape data.")
+                record('nt_parsed')
+                return None
+            print(f"Retrying ({retries}/{max_retries}) for {job_link}")
+            record('retries')
             try:
-                job_title_element = WebDriverWait(self.browser,2).until(
-                    EC.presence_of_element_located((By.CSS_SELECTOR, 'h2.top-card-layout__title, h1.top-card-layout__title')))
-                job_title = job_title_element.text if job_title_element else None
-                job_dict["job_title"] = str(job_title)
-
-                job_description_element = self.browser.find_element(By.CSS_SELECTOR,"div.show-more-less-html__markup")
-                job_description = job_description_element.get_attribute("innerHTML")
-                job_dict["job_description"] = str(job_description)
-
-                org_name_element = WebDriverWait(self.browser,2).until(
-                EC.presence_of_element_located((By.CSS_SELECTOR, 'a.topcard__org-name-link.topcard__flavor--black-link')))
-                org_name_text = org_name_element.text if org_name_element else None
-                job_dict["organization_name"] = str(org_name_text)
-
-                location_element = WebDriverWait(self.browser,2).until(
-                EC.presence_of_element_located((By.CSS_SELECTOR, 'span.topcard__flavor.topcard__flavor--bullet')))
-                location_text = location_element.text if location_element else None
-                job_dict["location"] = str(location_text)
-
-                Job_details  = self.browser.find_element(By.CLASS_NAME,"description__job-criteria-list")
-                Job_details = Job_details.text if Job_details else None
-                if Job_details: 
-                    Job_details = Job_details.split("\n")
-                    Job_details = [i.strip() for i in Job_details if i.strip() != ""]
-                else:
-                    Job_details = []
-                key_mapping = {"seniority level" : "seniority_level", 
-                               "employment type" : "employment_type", "job function":"job_function"} 
+                self.limiter.acquire()
+                with timed('page_load'):
+                    self.browser.get(job_link)
+                    self.wait_until(self.job_ready)
+            except Exception as retry_error:
+                # print(f"Error retrying: {str(retry_error)}")
+                pass
 
-                for i in range(0, len(Job_details), 2):
-                    original_key = Job_details[i].lower() 
-                    value = Job_details[i + 1] 
-                    if original_key in key_mapping:
-                        desired_key = key_mapping[original_key] 
-                    else:
-                        desired_key = original_key
+        return stamp(job_dict, job_link, key_words)
 
-                    job_dict[desired_key] = str(value)
+    #_____________________________________________________________________________________________________#
 
-                canonical_link = urljoin(job_link, urlparse(job_link).path)
-                job_dict["job_link"] = canonical_link 
+    def wait_until(self, cond, timeout=None):
+        try:
+            WebDriverWait(self.browser, timeout or self.timeout, poll_frequency=0.2).until(lambda d: cond())
+            return True
+        except TimeoutException:
+            return False
 
-                job_dict["source"] = self.source
-                
-                job_dict['searched_keyword'] = key_words
-                return job_dict
+    def job_ready(self):
+        return self.browser.execute_script(
+            "return !!document.querySelector('.description__job-criteria-list, "
+            ".contextual-sign-in-modal__modal-dismiss');")
+
+    # (number of results, page height, whether the show-more button is visible)
+    def results_state(self):
+        return self.browser.execute_script(
+            "const b = document.querySelector('.' + arguments[0]);"
+            "return [document.querySelectorAll('.jobs-search__results-list li').length,"
+            " document.body.scrollHeight, !!(b && b.offsetParent)];", self.target_button_class)
+
+    # Job links of the results from the start-th on, in page order.
+    def result_links(self, start):
+        hrefs = self.browser.execute_script(
+            "return Array.from(document.querySelectorAll('.jobs-search__results-list li')).slice(arguments[0])"
+            ".map(li => { const a = li.querySelector('a[href*=\"/jobs/view/\"]'); return a ? a.href : null; });", start)
+        links = [urljoin(href, urlparse(href).path) for href in hrefs if href]
+        return len(hrefs), list(dict.fromkeys(links))
+
+    def throttled(self):
+        url = self.browser.current_url
+        return 'authwall' in url or 'checkpoint' in url or '429' in self.browser.title
 
-            except Exception as e:
-                self.nt_parsed_link.append(job_link)
-                print(f"An error occurred:  - {str(e)}")
-                retries += 1
-                print(f"Retrying ({retries}/{max_retries}) for {job_link}")
-            
-                try:
-                    self.browser.get(job_link)
-                    time.sleep(2)
-                except Exception as retry_error:
-                    # print(f"Error retrying: {str(retry_error)}")
-                    pass         
-        print(f"Max retries reached for {job_link}. unable to scrape data.")
-        return None
-           
     #_____________________________________________________________________________________________________#
 
     def is_functionality_1_applicable(self):
@@ -165,180 +688,396 @@ class linked_in_JobScraper():
         except Exception as e:
             pass  
 
-    #____________________________________________________________________________________________________________#
+    #_____________________________________________________________________________________________________________#
 
-    def find_search_bar_with_retry(self, max_retries=random.randint(5,7), delay_between_retries=3):
+    def work(self):
+        while (task := self.frontier.get()) is not None:
+            try:
+                if task[0] == 'search':
+                    self.search(*task[1:])
+                else:
+                    self.scrape(*task[1:])
+            finally:
+                self.frontier.done()
+
+    #_____________________________________________________________________________________________________________#
+
+    # Results are sorted newest first and streamed into the frontier while
+    # scrolling; once known_run links in a row are already in the database,
+    # the rest of the results were seen by an earlier run.
+    def search(self, key, loc):
+        url = f"{base_url}&{urlencode({'keywords': key, 'location': loc, 'sortBy': 'DD'})}"
         retries = 0
+        max_retries = random.randint(4,7)
         while retries < max_retries:
             try:
-                search_bar = self.browser.find_element(By.XPATH,"//input[@id='job-search-bar-keywords']")
-                return search_bar
-            except NoSuchElementException:
-                print(f"Search bar not found. Retrying ({retries + 1}/{max_retries})...")
-                retries += 1
-                time.sleep(delay_between_retries)
+                self.limiter.acquire()
+                start = time.monotonic()
+                self.browser.get(url)
+                print(f'started scrapping for url : {key} with location {loc}' )
+                try:
+                    self.click_cancel_button()
+                    self.cancel_popup()
+                except NoSuchElementException:
+                    pass
+                try:
+                    if self.throttled():
+                        self.limiter.slow_down()
+                        raise NoSuchElementException("Throttled.")
+                    if not self.wait_until(lambda: self.results_state()[0] > 0):
+                        raise NoSuchElementException("No results.")
+                    record('search_submit_s', time.monotonic() - start)
+                    self.limiter.speed_up()
+                    self.browser.execute_script(f"window.scrollBy(0, {50});")
+                    # self.browser.save_screenshot(f'{key}, {loc}.png')
 
-        # print("Max retries reached. Unable to find the search bar.")
-        return None
+                    print('scrolling')
 
-    #_____________________________________________________________________________________________________________#
+                    taken, found, run = 0, 0, 0
+                    count, height, _ = self.results_state()
+                    for i in range(self.npages + 1):
+                        if self.frontier.stopped:
+                            return
+                        with timed('collect'):
+                            n, links = self.result_links(taken)
+                        taken += n
+                        with timed('touch'):
+                            known = self.touch(links) if links else set()
+                        self.frontier.add_jobs([link for link in links if link not in known], key)
+                        found += len(links) - len(known)
+                        for link in links:
+                            run = run + 1 if link in known else 0
+                        if self.known_run and run >= self.known_run:
+                            print(f'[{loc}]/[{key}]: caught up after {taken} results')
+                            break
+                        if i == self.npages:
+                            break
 
-    def scrape_and_store_batches(self, key_words, locations):
-        job_links = set()
-        
-        for loc in locations:
-            for key in key_words:
-                retries = 0
-                max_retries = random.randint(4,7)
-                while retries < max_retries:
-                    try:
-                        last_height = self.browser.execute_script("return document.body.scrollHeight")
-                        self.browser.get(base_url)
-                        print(f'started scrapping for url : {key} with location {loc}' )
-                        self.browser.maximize_window()
-                        time.sleep(2)
-                        try:
-                            self.click_cancel_button()
-                            self.cancel_popup()
-                        except NoSuchElementException:
-                            pass
-                        try:
-                            # Retry finding the search bar with a maximum of 5 retries
-                            search_bar = self.find_search_bar_with_retry()
-                            if not search_bar:
-                                raise NoSuchElementException("Search bar not found.")
-
-                            search_bar.clear()
-                            search_bar.send_keys(key)
-
-                            search_bar_location = self.browser.find_element(By.XPATH , "//input[@id='job-search-bar-location']")
-                            search_bar_location.clear()
-                            search_bar_location.send_keys(loc)
-
-                            button = self.browser.find_element(By.XPATH , "//button[@data-tracking-control-name='public_jobs_jobs-search-bar_base-search-bar-search-submit']")
-                            button.click()
-                            time.sleep(8)
-                            self.browser.execute_script(f"window.scrollBy(0, {50});")
-                            # self.browser.save_screenshot(f'{key}, {loc}.png')
-
-                            print('scrolling')
-                            
-                            for i in range(self.npages):
-                                self.browser.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-                                time.sleep(7)
+                        with timed('scroll'):
+                            self.browser.execute_script("window.scrollTo(0, document.body.scrollHeight);")
+                            def grown():
+                                n, h, more = self.results_state()
+                                return n > count or h > height or more
+                            if not self.wait_until(grown):
+                                break
+                            count, height, more = self.results_state()
+                            if more:
                                 try:
-                                    button = WebDriverWait(self.browser, 2).until(
-                                        EC.visibility_of_element_located((By.CLASS_NAME, self.target_button_class)))
-                                    button.click()
-                                    time.sleep(7)
+                                    self.browser.find_element(By.CLASS_NAME, self.target_button_class).click()
+                                    self.wait_until(lambda: self.results_state()[0] > count)
                                 except:
                                     pass
-                                new_height = self.browser.execute_script("return document.body.scrollHeight")
-                                if new_height == last_height:
-                                    break
-                                last_height = new_height
-                                
-                            # self.browser.save_screenshot(f'001_{key},{loc}.png')    
-
-                            time.sleep(2)
-                            html_list = self.browser.find_element(By.CLASS_NAME , 'jobs-search__results-list')
-                            job_links_list = html_list.find_elements(By.CSS_SELECTOR , 'div a')
-                            for link in job_links_list:
-                                if '/jobs/view/' in link.get_attribute('href'):
-                                    link = link.get_attribute('href')
-                                    canonical_link = urljoin(link, urlparse(link).path)
-                                    job_links.add(canonical_link)
-                            print(f'[{loc}]/[{key}]: {len(job_links)}')
-
-                            for url in tqdm(list(job_links)):
-                                if self.touch(url):
-                                    continue
-                                # print(f'started scraping for job_link....')
-                                try:
-                                    self.browser.get(url)
-                                    self.browser.maximize_window()
-                                    time.sleep(5)
-
-                                    func_01 = self.is_functionality_1_applicable()
-                                    if func_01 == False:
-                                        self.browser.execute_script(f"window.scrollBy(0, {50});")
-                                        try:
-                                            self.click_cancel_button()
-                                        except NoSuchElementException:
-                                            pass
-                                        time.sleep(3)
-                                        job_data = self.job_scrapper(url,key)
-                                        if job_data:
-                                            self.push_to_db(job_data)
-                                    else:
-                                        try:
-                                            self.cancel_popup()
-                                        except NoSuchElementException:
-                                            pass
-                                        time.sleep(2)
-                                        self.browser.execute_script(f"window.scrollBy(0, {50});")
-                                        time.sleep(2)
-                                        self.hit_see_job()
-                                        time.sleep(3)
-                                        try:
-                                            self.click_cancel_button()
-                                        except NoSuchElementException:
-                                            pass
-                                        random_sleep = random.randint(7, 25)
-                                        time.sleep(random_sleep)
-                                        job_data = self.job_scrapper(url,key)
-
-                                        if job_data:
-                                            self.push_to_db(job_data)
-                                        else:
-                                            print("Both methods failed to scrape job data")
-
-                                    self.links_processed += 1
-
-                                    if self.links_threshold != 0 and self.links_processed % self.links_threshold == 0:
-                                        print(
-                                            f"Processed {self.links_processed} links. Taking a pause for {self.pause_duration/60} minutes.")
-                                        time.sleep(self.pause_duration)
-
-                                except Exception as e:
-                                    print(f"Error while scraping {url}: {str(e)}")
-                            job_links.clear()
-                            print(f"Clearing previous links of location search {key} and location {loc} from the list")
-                            print(f'scrapping pause for {self.pause_duration} sec')
-                            time.sleep(self.pause_duration)
+                                count, height, _ = self.results_state()
 
-                            break
+                    # self.browser.save_screenshot(f'001_{key},{loc}.png')    
+
+                    print(f'[{loc}]/[{key}]: {found} new of {taken}')
+                    self.frontier.search_done(key, loc)
+                    return
+
+                except NoSuchElementException as e:
+                    # print(f"Element not found for {url}: {str(e)}")
+                    retries += 1
+                    record('retries')
+                    print(f"Retrying ({retries}/{max_retries}) for {key}")
+                    continue
+
+            except Exception as e:
+                print(f"An error occurred for {url}: {e}")
+                traceback.print_tb(e.__traceback__)
+                retries += 1
+                record('retries')
+                print(f"Retrying ({retries}/{max_retries}) for {key}")
+
+    #_____________________________________________________________________________________________________________#
+
+    def scrape(self, url, key):
+        # print(f'started scraping for job_link....')
+        try:
+            self.limiter.acquire()
+            start_page(self.browser)
+            with timed('page_load'):
+                self.browser.get(url)
+                self.wait_until(self.job_ready)
+            record_page(self.browser)
+            if self.throttled():
+                self.limiter.slow_down()
+                if not self.frontier.retry(url, key, self.throttle_retries):
+                    print(f"Still throttled on {url}, leaving it for the next run")
+                return
+
+            func_01 = self.is_functionality_1_applicable()
+            if func_01 == False:
+                self.limiter.speed_up()
+                self.browser.execute_script(f"window.scrollBy(0, {50});")
+                try:
+                    self.click_cancel_button()
+                except NoSuchElementException:
+                    pass
+                job_data = self.job_scrapper(url,key)
+                if job_data:
+                    self.writer.add(job_data)
+                else:
+                    self.frontier.drop(url)
+            else:
+                # The sign-in wall is the first sign of being throttled.
+                self.limiter.slow_down()
+                try:
+                    self.cancel_popup()
+                except NoSuchElementException:
+                    pass
+                self.browser.execute_script(f"window.scrollBy(0, {50});")
+                self.hit_see_job()
+                self.wait_until(lambda: self.browser.execute_script(
+                    "return !!document.querySelector('.description__job-criteria-list');"))
+                try:
+                    self.click_cancel_button()
+                except NoSuchElementException:
+                    pass
+                job_data = self.job_scrapper(url,key)
+
+                if job_data:
+                    self.writer.add(job_data)
+                else:
+                    print("Both methods failed to scrape job data")
+                    self.frontier.drop(url)
+
+            self.links_processed += 1
+
+        except Exception as e:
+            print(f"Error while scraping {url}: {str(e)}")
+
+#___________________________________________________________________________________________________________________________#
+
+def replay_id(key, loc, j):
+    return zlib.crc32(f'{key}|{loc}'.encode()) % 100000 * 1000 + j
+
+# Newest-first results for a search, 25 at a time as the page is scrolled.
+REPLAY_SEARCH = '''<html><head><title>Jobs</title></head><body>
+<ul class="jobs-search__results-list"></ul>
+<script>
+const ids = IDS;
+const list = document.querySelector('.jobs-search__results-list');
+let shown = 0, loading = false;
+function more() {
+    for (const id of ids.slice(shown, shown + 25))
+        list.insertAdjacentHTML('beforeend', `<li style="height:120px"><div class="base-card">
+            <a class="base-card__full-link" href="/jobs/view/${id}/?trk=replay">Job ${id}</a></div></li>`);
+    shown = Math.min(shown + 25, ids.length);
+    loading = false;
+}
+more();
+window.addEventListener('scroll', () => {
+    if (!loading && shown < ids.length && window.innerHeight + window.scrollY >= document.body.scrollHeight - 10) {
+        loading = true;
+        setTimeout(more, 300);
+    }
+});
+</script></body></html>'''
+
+REPLAY_MODAL = (b'<div class="contextual-sign-in-modal"><button class="contextual-sign-in-modal__modal-dismiss" '
+                b'onclick="this.parentNode.remove()">Dismiss</button></div>')
+
+# Serves recorded job pages as /jobs/view/<i>/ from a local keep-alive server.
+# With faults, it also serves synthetic search results (results per search)
+# and deterministically injects a sign-in modal, drops the description or
+# delays the answer for the given share of job pages.
+def serve_fixtures(pages, faults=None, results=0):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            m = re.match(r'/jobs/view/(\d+)/', url.path)
+            if m:
+                i = int(m[1])
+                body = pages[i % len(pages)]
+                if faults:
+                    rng = random.Random(i)
+                    if rng.random() < faults['slow']:
+                        time.sleep(faults['delay'])
+                    if rng.random() < faults['missing']:
+                        body = body.replace(b'show-more-less-html__markup', b'show-more-less-html__removed')
+                    if rng.random() < faults['modal']:
+                        body = body.replace(b'</body>', REPLAY_MODAL + b'</body>')
+            elif url.path == '/jobs/search/' and results:
+                q = parse_qs(url.query)
+                key, loc = q.get('keywords', [''])[0], q.get('location', [''])[0]
+                body = REPLAY_SEARCH.replace('IDS', json.dumps([replay_id(key, loc, j) for j in range(results)])).encode()
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Reads the same recorded pages through the HTTP fast path and through Chrome.
+def bench(files):
+    pages = []
+    for f in files:
+        with open(f, 'rb') as file:
+            pages.append(file.read())
+    server = serve_fixtures(pages)
+    n = int(os.environ.get('JB_BENCH_PAGES', '200'))
+    urls = [f'http://127.0.0.1:{server.server_port}/jobs/view/{i % len(pages)}/' for i in range(n)]
+    unlimited = RateLimiter(float('inf'))
+
+    http = http_pool(http_threads)
+    t = time.monotonic()
+    with ThreadPoolExecutor(http_threads) as ex:
+        jobs = list(ex.map(lambda url: fetch_job(http, unlimited, url), urls))
+    dt = time.monotonic() - t
+    print(f'http: {n} pages in {dt:.2f}s, {n / dt:.1f} pages/s, {jobs.count(None)} incomplete')
+
+    n = min(n, int(os.environ.get('JB_BENCH_BROWSER_PAGES', '20')))
+    with scratch_profile() as profile:
+        browser = the_browser(profile)
+        try:
+            t = time.monotonic()
+            incomplete = 0
+            for url in urls[:n]:
+                start_page(browser)
+                browser.get(url)
+                record_page(browser)
+                _, missing = extract_job(browser)
+                incomplete += any(k in missing for k in REQUIRED_FIELDS)
+            dt = time.monotonic() - t
+            print(f'browser: {n} pages in {dt:.2f}s, {n / dt:.1f} pages/s, {incomplete} incomplete ({"lean" if lean else "full"} profile)')
+        finally:
+            browser.quit()
+    server.shutdown()
+    report()
+
+# Runs the whole scraper against serve_fixtures() in a scratch jb_replay
+# schema and reports jobs per hour with the per-stage timings.  Each of
+# JB_REPLAY_SEARCHES searches returns JB_REPLAY_RESULTS results, all but the
+# newest JB_REPLAY_NEW of which are already known.  Set JB_REPLAY_KEEP to keep
+# the schema.  With the HTTP fast path on, browsers only see the pages it
+# could not read; JB_HTTP_THREADS=0 replays everything through Chrome.
+def replay(dsn, files):
+    global base_url
+    pages = []
+    for f in files:
+        with open(f, 'rb') as file:
+            pages.append(file.read())
+    faults = {k: float(os.environ.get(f'JB_REPLAY_{k.upper()}', v))
+              for k, v in [('modal', '0.1'), ('missing', '0.05'), ('slow', '0.1'), ('delay', '2')]}
+    results = int(os.environ.get('JB_REPLAY_RESULTS', '100'))
+    new = int(os.environ.get('JB_REPLAY_NEW', '50'))
+    keywords = [f'keyword {i}' for i in range(int(os.environ.get('JB_REPLAY_SEARCHES', '4')))]
+    locations = ['Replay']
+    server = serve_fixtures(pages, faults, results)
+    root = f'http://127.0.0.1:{server.server_port}'
+    base_url = f'{root}/jobs/search/?position=1&pageNum=0'
+    with psycopg.connect(dsn, autocommit=True) as conn:
+        conn.execute("DROP SCHEMA IF EXISTS jb_replay CASCADE")
+        conn.execute("CREATE SCHEMA jb_replay")
+        conn.execute("""
+CREATE TABLE jb_replay.jobs (job_link text PRIMARY KEY, job_title text, job_description text, organization_name text,
+  location text, department text, key_skills text, seniority_level text, employment_type text, industries text,
+  job_function text, source text, searched_keyword text, applied boolean, atime timestamptz)""")
+        with conn.cursor() as cur:
+            cur.executemany("INSERT INTO jb_replay.jobs (job_link, applied) VALUES (%s, false)",
+                [(f'{root}/jobs/view/{replay_id(key, loc, j)}/',) for loc in locations for key in keywords for j in range(new, results)])
+    try:
+        elapsed = run(dsn, keywords, locations, results // 25 + 1, options='-c search_path=jb_replay')
+    finally:
+        server.shutdown()
+        if os.environ.get('JB_REPLAY_KEEP', '') == '':
+            with psycopg.connect(dsn, autocommit=True) as conn:
+                conn.execute("DROP SCHEMA jb_replay CASCADE")
+    report(elapsed)
+
+http_threads = int(os.environ.get('JB_HTTP_THREADS', '8'))
+
+if sys.argv[1] == 'extract':
+    with scratch_profile() as profile:
+        browser = the_browser(profile)
+        try:
+            for f in sys.argv[2:]:
+                browser.get('file://' + os.path.abspath(f))
+                job_dict, missing = extract_job(browser)
+                print(json.dumps({'file': f, 'job': job_dict, 'missing': missing}))
+        finally:
+            browser.quit()
+    sys.exit(0)
+
+if sys.argv[1] == 'bench':
+    bench(sys.argv[2:])
+    sys.exit(0)
+
+sessions = int(os.environ.get('JB_SESSIONS', '1'))
+profiles = os.environ.get('JB_PROFILE_DIR', '')
+
+# Scrapes every (keyword, location) pair with the session pool and the HTTP
+# fetchers, and returns the wall-clock time it took.
+def run(dsn, keywords, locations, npages, **connect_args):
+    # JB_RATE is the page budget for the whole run, shared by the browser
+    # sessions and the HTTP fetchers, so that the site sees a single pace.
+    limiter = RateLimiter(float(os.environ.get('JB_RATE', '20')))
+    http = http_pool(http_threads)
+
+    # Each session drives its own Chrome profile and database connection.
+    def run_session(i):
+        if profiles:
+            profile_dir = contextlib.nullcontext(os.path.join(profiles, str(i)))
+        else:
+            profile_dir = scratch_profile()
+        try:
+            with profile_dir as profile, psycopg.connect(dsn, autocommit=True, **connect_args) as conn:
+                with conn.cursor() as cur:
+                    scrapper = linked_in_JobScraper(cur, writer, npages, frontier, limiter, profile)
+                    try:
+                        scrapper.work()
+                    finally:
+                        scrapper.browser.quit()
+        finally:
+            frontier.leave()
+
+    def run_fetcher():
+        JobFetcher(writer, frontier, limiter, http).work()
+
+    with psycopg.connect(dsn, autocommit=True, **connect_args) as conn, \
+         psycopg.connect(dsn, autocommit=True, **connect_args) as frontier_conn:
+        frontier = Frontier(frontier_conn, fast=http_threads > 0, sessions=sessions)
+        frontier.load(keywords, locations, float(os.environ.get('JB_SEARCH_INTERVAL', '20')))
+        writer = JobWriter(conn, int(os.environ.get('JB_FLUSH_SIZE', '50')), float(os.environ.get('JB_FLUSH_SECONDS', '30')))
+        # On Ctrl-C the workers are stopped and waited for before the writer
+        # flushes and the connections close; a second Ctrl-C quits at once.
+        threads = [threading.Thread(target=run_session, args=(i,), daemon=True) for i in range(sessions)]
+        threads += [threading.Thread(target=run_fetcher, daemon=True) for i in range(http_threads)]
+        start = time.monotonic()
+        for t in threads:
+            t.start()
+        try:
+            for t in threads:
+                t.join()
+        except KeyboardInterrupt:
+            print('Interrupted, finishing the pages in progress (Ctrl-C again to quit now)')
+            frontier.stop()
+            for t in threads:
+                t.join()
+        finally:
+            writer.close()
+        return time.monotonic() - start
 
-                        except NoSuchElementException as e:
-                            # print(f"Element not found for {base_url}: {str(e)}")
-                            retries += 1
-                            print(f"Retrying ({retries}/{max_retries}) for {key}")
-                            continue
-
-                    except Exception as e:
-                        print(f"An error occurred for {base_url}: {e}")
-                        traceback.print_tb(e.__traceback__)
-                        retries += 1
-                        print(f"Retrying ({retries}/{max_retries}) for {key}")
-    #____________________________________________________________________________________________________________#
-
-    def push_to_db(self, job_data):
-        # self.job_data_df = pd.DataFrame(columns=["job_title", "job_description", "organization_name", 
-        #               "location", "department", "key_skills", "seniority_level", 
-        #               "employment_type", "industries", "job_function", "job_link","source","searched_keyword"])
-        fields = ['applied']
-        values = [False]
-        for k in job_data:
-            fields.append(k)
-            values.append(job_data[k])
-        self.cur.execute(f"INSERT INTO jobs ({','.join(fields)}) VALUES ({','.join(['%s']*len(values))}) ON CONFLICT DO NOTHING", values)
+if sys.argv[1] == 'replay':
+    replay(sys.argv[2], sys.argv[3:])
+    sys.exit(0)
 
 with open(sys.argv[1]) as file:
     keywords = [line.strip() for line in file if not line.startswith('#')]
 with open(sys.argv[2]) as file:
     locations = [line.strip() for line in file if not line.startswith('#')]
 
-with psycopg.connect(sys.argv[4], autocommit=True) as conn:
-    with conn.cursor() as cur:
-        scrapper = linked_in_JobScraper(cur, int(sys.argv[3]))
-        scrapper.scrape_and_store_batches(keywords,locations) 
+report(run(sys.argv[4], keywords, locations, int(sys.argv[3])))
@@ -1,18 +1,254 @@
 #!/usr/bin/env python
 
+import contextlib
+import hashlib
+import ipaddress
+import os
+import queue
+import random
+import re
 import sys
+import threading
+import time
 
 if len(sys.argv) not in [3,4]:
     print(f'Usage: {sys.argv[0]} [process|monitor|job_link] postgresql://[username]:[password]@[host]:[port]/[database] [-n]')
+    print(f'       {sys.argv[0]} bench postgresql://[username]:[password]@[host]:[port]/[database]')
+    print(f'       {sys.argv[0]} serve [socket|host:port]')
     sys.exit(1)
 
 import psycopg
 from tqdm import trange, tqdm
+from html.parser import HTMLParser
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
 from transformers import AutoModelForCausalLM, T5ForConditionalGeneration, AutoTokenizer
 import torch
 
-model = T5ForConditionalGeneration.from_pretrained("google/flan-ul2", device_map="cuda:0", torch_dtype=torch.bfloat16, load_in_4bit=True)
-tokenizer = AutoTokenizer.from_pretrained("google/flan-ul2")
+from psycopg import sql
+
+MODEL = "google/flan-ul2"
+
+batch_size = int(os.environ.get('LLM_BATCH_SIZE', '8'))
+fetch_size = int(os.environ.get('LLM_FETCH_SIZE', '10'))
+scoring = os.environ.get('LLM_SCORING', 'logits')
+store_confidence = os.environ.get('LLM_CONFIDENCE', '') != ''
+use_cache = os.environ.get('LLM_NO_CACHE', '') == ''
+lease = int(os.environ.get('LLM_LEASE', '600'))
+queue_depth = int(os.environ.get('LLM_QUEUE_DEPTH', '2'))
+window = float(os.environ.get('LLM_WINDOW', '2'))
+server = os.environ.get('LLM_SERVER', '')
+authkey = os.environ.get('LLM_AUTHKEY', '').encode()
+max_tokens = int(os.environ.get('LLM_MAX_TOKENS', '3072'))
+boilerplate_orgs = int(os.environ.get('LLM_BOILERPLATE_ORGS', '5'))
+backend_kind = os.environ.get('LLM_BACKEND', 'cuda')
+stats = {'hit': 0, 'miss': 0, 'jobs': 0, 'raw_tokens': 0, 'tokens': 0}
+# With -n, writes are printed instead of executed and the queue is left alone.
+dry_run = len(sys.argv) == 4
+# Answers computed by this process that the write-behind stage may not have
+# stored in ai_cache yet.  Read by the prefetch thread, filled by the main one.
+recent = {}
+recent_lock = threading.Lock()
+
+if scoring not in ['logits','generate']:
+    print(f'Unknown LLM_SCORING {scoring}')
+    sys.exit(1)
+
+# Every backend answers run(mode,input_ids) with one result per row: the
+# decoded text for generate, the candidate token probabilities for logits.
+# The name identifies the answers it gives in ai_cache, the model_name
+# selects the tokenizer.
+class Seq2SeqBackend:
+    device = 'cuda'
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.name = model_name
+        self.model = None
+
+    # The weights take a minute or more to load, so they are only loaded once
+    # a query actually needs the model.
+    def get_model(self):
+        if self.model is None:
+            self.model = self.load()
+        return self.model
+
+    def generate(self, input_ids):
+        model = self.get_model()
+        model_inputs = tokenizer.pad({'input_ids': input_ids}, return_tensors='pt').to(self.device)
+        generated_ids = model.generate(**model_inputs, max_length=10)
+        return tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
+
+    # Run the encoder and one decoder step only, returning the probabilities
+    # of the candidate answer tokens for each row.
+    def score(self, input_ids):
+        model = self.get_model()
+        model_inputs = tokenizer.pad({'input_ids': input_ids}, return_tensors='pt').to(self.device)
+        start = torch.full((len(input_ids),1), model.config.decoder_start_token_id, device=self.device)
+        with torch.no_grad():
+            logits = model(**model_inputs, decoder_input_ids=start).logits[:, -1, :]
+        probs = logits.float().softmax(-1)[:, candidate_ids].tolist()
+        return [dict(zip(candidate_ids, p)) for p in probs]
+
+    def run(self, mode, input_ids):
+        if mode == 'logits':
+            return self.score(input_ids)
+        return self.generate(input_ids)
+
+class CudaBackend(Seq2SeqBackend):
+    def __init__(self):
+        super().__init__(MODEL)
+
+    def load(self):
+        return T5ForConditionalGeneration.from_pretrained(self.model_name, device_map="cuda:0", torch_dtype=torch.bfloat16, load_in_4bit=True)
+
+# A smaller model for machines without a GPU, optionally with its linear
+# layers quantized to int8.
+class CpuBackend(Seq2SeqBackend):
+    device = 'cpu'
+
+    def __init__(self):
+        super().__init__(os.environ.get('LLM_CPU_MODEL', 'google/flan-t5-large'))
+        self.int8 = os.environ.get('LLM_CPU_INT8', '') != ''
+        if self.int8:
+            self.name += ':int8'
+
+    def load(self):
+        torch.set_num_threads(int(os.environ.get('LLM_THREADS', os.cpu_count())))
+        model = T5ForConditionalGeneration.from_pretrained(self.model_name, torch_dtype=torch.float32)
+        if self.int8:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model.eval()
+
+# Answers deterministically from the input tokens after sleeping
+# LLM_FAKE_LATENCY seconds per batch plus LLM_FAKE_TOKEN_LATENCY seconds per
+# thousand padded tokens, so everything around the model can be profiled.
+class FakeBackend:
+    name = 'fake'
+
+    def __init__(self):
+        self.model_name = os.environ.get('LLM_FAKE_TOKENIZER', MODEL)
+        self.latency = float(os.environ.get('LLM_FAKE_LATENCY', '0.05'))
+        self.token_latency = float(os.environ.get('LLM_FAKE_TOKEN_LATENCY', '0.01'))
+
+    def get_model(self):
+        pass
+
+    def run(self, mode, input_ids):
+        width = max(len(ids) for ids in input_ids)
+        time.sleep(self.latency + self.token_latency * width * len(input_ids) / 1000)
+        results = []
+        for ids in input_ids:
+            rng = random.Random(hashlib.sha256(str(ids).encode()).digest())
+            if mode == 'logits':
+                results.append({i: rng.random() for i in candidate_ids})
+            else:
+                results.append(str(rng.randrange(11)))
+        return results
+
+# The daemon unpickles what its clients send, so it only ever listens on a
+# Unix socket or a loopback address, behind an explicit LLM_AUTHKEY.
+def parse_address(addr):
+    if '/' in addr:
+        return addr
+    host,port = addr.rsplit(':', 1)
+    host = host.strip('[]')
+    try:
+        loopback = host == 'localhost' or ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        loopback = False
+    if not loopback:
+        raise ValueError(f'{host} is not a loopback address')
+    return host,int(port)
+
+# Losing the daemon is not the fault of the rows in flight, so it stops the
+# run instead of failing them.
+class ServerGone(Exception):
+    pass
+
+# Talks to the llm.py serve daemon, which keeps the model resident.  If the
+# daemon restarts, the request is resent once it is back, for up to 30s.
+class RemoteBackend:
+    def __init__(self, addr):
+        self.addr = addr
+        self.conn = Client(parse_address(addr), authkey=authkey)
+        self.name,self.model_name = self.call('info')
+
+    def send(self, request):
+        self.conn.send(request)
+        ok,res = self.conn.recv()
+        if not ok:
+            raise res
+        return res
+
+    def call(self, *request):
+        try:
+            return self.send(request)
+        except (OSError, EOFError):
+            pass
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                self.conn = Client(parse_address(self.addr), authkey=authkey)
+                if self.send(('info',)) != (self.name,self.model_name):
+                    raise ServerGone(f'{self.addr} now serves a different model')
+                return self.send(request)
+            except (OSError, EOFError, AuthenticationError) as e:
+                if time.monotonic() > deadline:
+                    raise ServerGone(f'Lost {self.addr}: {e!r}') from e
+                time.sleep(1)
+
+    def get_model(self):
+        pass
+
+    def run(self, mode, input_ids):
+        return self.call('run', mode, input_ids)
+
+BACKENDS = {'cuda': CudaBackend, 'cpu': CpuBackend, 'fake': FakeBackend}
+
+if backend_kind not in BACKENDS:
+    print(f'Unknown LLM_BACKEND {backend_kind}')
+    sys.exit(1)
+
+# With LLM_SERVER set, inference goes to the daemon; if the daemon cannot be
+# reached the LLM_BACKEND model is loaded locally instead.
+def make_backend():
+    if server and sys.argv[1] != 'serve':
+        try:
+            if not authkey:
+                raise ValueError('LLM_AUTHKEY is not set')
+            return RemoteBackend(server)
+        except (OSError, ValueError) as e:
+            print(f'Cannot reach {server}, using the local model: {e}')
+    return BACKENDS[backend_kind]()
+
+backend = make_backend()
+tokenizer = AutoTokenizer.from_pretrained(backend.model_name)
+# Bumped whenever clean() changes, so that texts and answers derived from the
+# old cleaning are not reused.
+cleaner = 2
+
+# Answers that a single decoder step can produce, keyed by token id.  Numbers
+# always generate: the first token of a number the model would write in
+# several tokens is itself a candidate, so one step would store a wrong value.
+ANSWERS = {
+    'boolean': {'yes': True, 'Yes': True, 'no': False, 'No': False},
+}
+
+def mode_of(ty):
+    return scoring if ty in ANSWERS else 'generate'
+
+def model_id(ty):
+    return f'{backend.name}:{mode_of(ty)}:text{max_tokens}' + (f':clean{cleaner}' if cleaner > 1 else '')
+
+candidates = {}
+for ty,words in ANSWERS.items():
+    candidates[ty] = {}
+    for w,v in words.items():
+        ids = tokenizer(w, add_special_tokens=False)['input_ids']
+        if len(ids) == 1:
+            candidates[ty][ids[0]] = v
+candidate_ids = sorted(set(i for c in candidates.values() for i in c))
 
 def get_fields(conn):
     with conn.cursor() as cur:
@@ -21,87 +257,740 @@ SELECT a.attname as fld,
   pg_catalog.format_type(a.atttypid, a.atttypmod) as ty,
   pg_catalog.col_description(a.attrelid, a.attnum) as cmt
 FROM pg_catalog.pg_attribute a
-WHERE a.attrelid = (SELECT oid FROM pg_class WHERE relname = 'jobs')
+WHERE a.attrelid = 'jobs'::regclass
   AND a.attnum > 0 AND NOT a.attisdropped AND a.attname ~ 'ai_.*'
   AND a.attname != 'ai_fail'
 ORDER BY a.attnum;""")
         return cur.fetchall()
 
-def process_single(triple,job_link,job_description):
-    fld,ty,cmt = triple
+def normalize(job_description):
+    return ' '.join(job_description.split())
+
+def digest(*parts):
+    return hashlib.sha256('\0'.join(parts).encode()).digest()
+
+# Answers depend on the description, the question and the model only, so
+# reposts of the same job under different links share their cache entries.
+def cache_key(triple,job_description):
+    _,ty,cmt = triple
+    return digest(model_id(ty), ty, cmt, normalize(job_description))
+
+# Drop the entries computed from an outdated column comment.
+def invalidate_cache(conn,fields):
+    execute(conn, ("DELETE FROM ai_cache AS c USING unnest(%s::name[], %s::bytea[]) AS f(fld, cmt_hash) WHERE c.fld = f.fld AND c.cmt_hash <> f.cmt_hash",
+        ([fld for fld,_,_ in fields], [digest(ty,cmt) for _,ty,cmt in fields])))
+
+BLOCK_TAGS = {'address','article','br','dd','div','dl','dt','h1','h2','h3','h4','h5','h6',
+              'header','footer','hr','li','ol','p','section','table','tr','ul'}
+SKIP_TAGS = {'script','style','template'}
+BOILERPLATE = re.compile(r'equal (employment )?opportunit|affirmative action|reasonable accommodation|'
+                         r'without regard to|e-verify|pay transparency|privacy (policy|notice)', re.I)
+BENEFITS = re.compile(r'401\(?k\)?|\bdental\b|\bvision\b|paid time off|\bPTO\b|parental leave|'
+                      r'life insurance|tuition|wellness', re.I)
+
+# Splits the innerHTML captured by the scraper into blocks of plain text.
+class TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.blocks = [[]]
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self.skip += 1
+        elif tag in BLOCK_TAGS:
+            self.blocks.append(['- '] if tag == 'li' else [])
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self.skip = max(0, self.skip - 1)
+        elif tag in BLOCK_TAGS:
+            self.blocks.append([])
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.blocks[-1].append(data)
+
+def html_blocks(html):
+    parser = TextExtractor()
+    parser.feed(html or '')
+    parser.close()
+    blocks = [normalize(''.join(b)) for b in parser.blocks]
+    return [b for b in blocks if b not in ['', '-']]
+
+SENTENCE = re.compile(r'(?<=[.!?])\s+')
+# Cleaning that keeps less than this share of the text falls back to all of it.
+MIN_KEPT = 0.25
+
+def is_boilerplate(sentence):
+    return BOILERPLATE.search(sentence) is not None or len(BENEFITS.findall(sentence)) >= 3
+
+# Drops the EEO and benefits sentences of a block, keeping the rest of it.
+def strip_boilerplate(block):
+    return ' '.join(s for s in SENTENCE.split(block) if not is_boilerplate(s))
+
+# jobs maps job_link to (html,organization_name,stored text).  Converts the
+# HTML of the jobs that need answers but have no stored text yet, dropping
+# EEO and benefits sentences as well as the long blocks that already appeared
+# in the descriptions of boilerplate_orgs other organizations.  When that
+# leaves too little, the text is kept whole.  Returns the texts and the
+# updates recording the blocks seen.
+def clean(cur,jobs,items):
+    todo = {jl: jobs[jl] for _,jl,_ in items if jobs[jl][2] is None}
+    blocks = {jl: html_blocks(html) for jl,(html,_,_) in todo.items()}
+    hashes = {jl: [digest(b) if len(b) >= 100 else None for b in bs] for jl,bs in blocks.items()}
+    common = set()
+    if todo:
+        cur.execute("SELECT hash FROM ai_text_blocks WHERE hash = ANY(%s) GROUP BY hash HAVING count(*) >= %s",
+            (list({h for hs in hashes.values() for h in hs if h}), boilerplate_orgs))
+        common = {bytes(h) for h, in cur}
+    texts = {}
+    updates = []
+    for jl,bs in blocks.items():
+        raw = '\n'.join(bs)
+        kept = [strip_boilerplate(b) for b,h in zip(bs,hashes[jl]) if h not in common]
+        text = '\n'.join(b for b in kept if b not in ['', '-'])
+        texts[jl] = text if len(text) >= MIN_KEPT * len(raw) else raw
+        org = todo[jl][1]
+        if org:
+            updates += [update_block(h,org) for h in set(hashes[jl]) if h]
+    return texts,updates
+
+# Cuts the cleaned texts to max_tokens tokens, in place, and records the token
+# counts before (the 16300 characters of HTML the model used to read) and after.
+def trim(texts,jobs):
+    updates = []
+    for jl,text in texts.items():
+        enc = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        tokens = len(enc['input_ids'])
+        if tokens > max_tokens:
+            text = text[:enc['offset_mapping'][max_tokens-1][1]]
+            tokens = max_tokens
+        raw = len(tokenizer((jobs[jl][0] or '')[0:16300], add_special_tokens=False)['input_ids'])
+        texts[jl] = text
+        stats['jobs'] += 1
+        stats['raw_tokens'] += raw
+        stats['tokens'] += tokens
+        updates.append(update_text(jl,text,raw,tokens))
+    return updates
+
+def with_stored(texts,jobs):
+    return {**{jl: t for jl,(_,_,t) in jobs.items() if t is not None}, **texts}
+
+PROMPT = 'Read the following job description and answer questions.\n\n'
+
+def check_type(ty):
     if ty not in ['boolean','smallint']:
         print(f'Unknown type {ty}')
         sys.exit(2)
-    jd = 'Read the following job description and answer questions.\n\n'
-    jd += job_description[0:16300]
-    jd += '\n\n'
-    jd += cmt
+
+def make_prompt(cmt,text):
+    return PROMPT + text + '\n\n' + cmt
+
+def parse_result(ty,result):
+    if ty == 'boolean':
+        return result.strip().lower() == "yes"
+    return int(float(result.split(' ')[0]))
+
+def update_ok(fld,job_link,res):
+    return f"UPDATE jobs SET {fld} = %s, mtime = CURRENT_TIMESTAMP WHERE job_link = %s", (res,job_link)
+
+def update_fail(fld,job_link):
+    return "UPDATE jobs SET ai_fail = (%s || ',' || ai_fail), mtime = CURRENT_TIMESTAMP WHERE job_link = %s", (fld,job_link)
+
+def update_confidence(fld,job_link,p):
+    return "INSERT INTO ai_confidence (job_link, fld, p) VALUES (%s, %s, %s) ON CONFLICT (job_link, fld) DO UPDATE SET p = EXCLUDED.p", (job_link,fld,p)
+
+def update_cache(key,fld,ty,cmt,res,p):
+    return "INSERT INTO ai_cache (key, fld, cmt_hash, answer, p) VALUES (%s, %s, %s, %s, %s) ON CONFLICT (key) DO NOTHING", (key,fld,digest(ty,cmt),int(res),p)
+
+def update_text(job_link,text,raw,tokens):
+    return "INSERT INTO ai_text (job_link, budget, cleaner, text, raw_tokens, tokens) VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT (job_link) DO UPDATE SET budget = EXCLUDED.budget, cleaner = EXCLUDED.cleaner, text = EXCLUDED.text, raw_tokens = EXCLUDED.raw_tokens, tokens = EXCLUDED.tokens", (job_link,max_tokens,cleaner,text,raw,tokens)
+
+def update_block(h,org):
+    return "INSERT INTO ai_text_blocks (hash, org) VALUES (%s, %s) ON CONFLICT DO NOTHING", (h,org)
+
+def pick(ty,probs):
+    votes = {}
+    for i,v in candidates[ty].items():
+        votes[v] = votes.get(v, 0) + probs[i]
+    res = max(votes, key=votes.get)
+    return res, votes[res] / sum(votes.values())
+
+def infer(mode,input_ids):
+    return backend.run(mode,input_ids)
+
+# Halve the batch until it fits; a single row that still does not fit fails.
+def infer_split(mode,input_ids):
     try:
-        model_inputs = tokenizer([jd], return_tensors='pt').to('cuda')
-        generated_ids = model.generate(**model_inputs, max_length=10)
-        results = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
+        return infer(mode,input_ids)
+    except torch.cuda.OutOfMemoryError:
+        torch.cuda.empty_cache()
+        if len(input_ids) == 1:
+            raise
+        mid = len(input_ids) // 2
+        return infer_split(mode,input_ids[:mid]) + infer_split(mode,input_ids[mid:])
+
+def encode(items,texts):
+    for (_,ty,_),_,_ in items:
+        check_type(ty)
+    if not items:
+        return []
+    return tokenizer([make_prompt(cmt,texts[jl]) for (_,_,cmt),jl,_ in items])['input_ids']
+
+# Each item is a (triple,job_link,job_description); returns one (res,p) answer
+# or the exception that prevented it per item.  Items are bucketed by token
+# length so that rows padded together have similar lengths, and batches never
+# mix scoring modes.  A failing batch is retried row by row so that only the
+# rows that actually failed error out.
+def answer_encoded(items,encoded):
+    modes = [mode_of(ty) for (_,ty,_),_,_ in items]
+    order = sorted(range(len(items)), key=lambda i: len(encoded[i]))
+    chunks = []
+    for mode in sorted(set(modes)):
+        rows = [i for i in order if modes[i] == mode]
+        chunks += [(mode,rows[k:k+batch_size]) for k in range(0, len(rows), batch_size)]
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    for mode,chunk in chunks:
+        try:
+            for i,r in zip(chunk, infer_split(mode,[encoded[i] for i in chunk])):
+                results[i] = r
+        except KeyboardInterrupt:
+            sys.exit(130)
+        except ServerGone:
+            raise
+        except Exception as e:
+            if len(chunk) == 1:
+                errors[chunk[0]] = e
+                continue
+            for i in chunk:
+                try:
+                    results[i] = infer_split(mode,[encoded[i]])[0]
+                except KeyboardInterrupt:
+                    sys.exit(130)
+                except ServerGone:
+                    raise
+                except Exception as e:
+                    errors[i] = e
+    answers = []
+    for ((_,ty,_),_,_),mode,result,error in zip(items,modes,results,errors):
+        if error is not None:
+            answers.append(error)
+            continue
+        try:
+            if mode == 'logits':
+                answers.append(pick(ty,result))
+            else:
+                answers.append((parse_result(ty,result),None))
+        except Exception as e:
+            answers.append(e)
+    return answers
+
+# Answers are looked up in ai_cache first; every distinct missing key (listed
+# in todo with the rows sharing it) is run through the model only once.
+# Jobs without a description fail without reaching the model.
+def lookup(cur,items):
+    if use_cache:
+        keys = [cache_key(triple,jd) if jd is not None else i for i,(triple,_,jd) in enumerate(items)]
+    else:
+        keys = list(range(len(items)))
+    answers = {keys[i]: ValueError('job_description is NULL') for i,(_,_,jd) in enumerate(items) if jd is None}
+    if use_cache:
+        with recent_lock:
+            answers.update({k: recent[k] for k in keys if k in recent})
+        cur.execute("SELECT key, answer, p FROM ai_cache WHERE key = ANY(%s)",
+            (list({k for k in keys if isinstance(k, bytes)} - answers.keys()),))
+        answers.update({bytes(k): (a,p) for k,a,p in cur})
+    todo = {}
+    for i,k in enumerate(keys):
+        if k not in answers:
+            todo.setdefault(k, []).append(i)
+    stats['hit'] += len(items) - len(todo)
+    stats['miss'] += len(todo)
+    return keys,answers,todo
+
+def collect(items,keys,answers,todo):
+    updates = []
+    for ((fld,ty,_),job_link,_),k in zip(items,keys):
+        a = answers[k]
+        if isinstance(a, Exception):
+            print(f'[{fld}] {job_link} [error]')
+            print(a)
+            updates.append(update_fail(fld,job_link))
+            continue
+        res,p = a
         if ty == 'boolean':
-            res = results[0].strip().lower() == "yes"
-        else:
-            res = int(float(results[0].split(' ')[0]))
-        return f"UPDATE jobs SET {fld} = %s, mtime = CURRENT_TIMESTAMP WHERE job_link = %s", (res,job_link)
-    except KeyboardInterrupt:
-        sys.exit(130)
-    except Exception as e:
-        print(f'[{fld}] {job_link} [error]')
-        print(e)
-        return "UPDATE jobs SET ai_fail = (%s || ',' || ai_fail), mtime = CURRENT_TIMESTAMP WHERE job_link = %s", (fld,job_link)
+            res = bool(res)
+        updates.append(update_ok(fld,job_link,res))
+        if store_confidence and p is not None:
+            updates.append(update_confidence(fld,job_link,p))
+    if use_cache:
+        with recent_lock:
+            if len(recent) > 100000:
+                recent.clear()
+            for k,v in todo.items():
+                if not isinstance(answers[k], Exception):
+                    (fld,ty,cmt),_,_ = items[v[0]]
+                    updates.append(update_cache(k,fld,ty,cmt,*answers[k]))
+                    recent[k] = answers[k]
+    return updates
+
+def process_batch(cur,items,jobs):
+    keys,answers,todo = lookup(cur,items)
+    misses = [items[v[0]] for v in todo.values()]
+    texts,updates = clean(cur,jobs,misses)
+    updates += trim(texts,jobs)
+    for k,a in zip(todo, answer_encoded(misses,encode(misses,with_stored(texts,jobs)))):
+        answers[k] = a
+    return updates + collect(items,keys,answers,todo)
+
+def progress():
+    postfix = {}
+    if use_cache:
+        postfix['hit'] = stats['hit']
+        postfix['miss'] = stats['miss']
+        postfix['rate'] = f"{stats['hit'] / max(1, stats['hit'] + stats['miss']):.0%}"
+    if stats['jobs']:
+        postfix['tokens'] = f"{stats['raw_tokens'] // stats['jobs']}->{stats['tokens'] // stats['jobs']}"
+        postfix['saved'] = f"{1 - stats['tokens'] / max(1, stats['raw_tokens']):.0%}"
+    return postfix
+
+# ai_fail is a comma separated list of the fields that failed.
+def pending(fld):
+    return f"({fld} IS NULL AND NOT ('{fld}' = ANY(string_to_array(ai_fail, ','))))"
 
 def execute(cur, obj):
-    if len(sys.argv) == 4:
+    if dry_run:
         print(f'cur.execute(*{obj})')
     else:
         cur.execute(*obj)
 
-def process_one(conn,job_link):
-    for triple in tqdm(get_fields(conn)):
-        fld = triple[0]
-        with conn.cursor() as cur:
-            cur.execute(f"SELECT job_description FROM jobs WHERE job_link = %s AND {fld} IS NULL AND (ai_fail !~ '(?<![a-z_]){fld}(?![a-z_])')", (job_link,))
-            res = cur.fetchone()
-            if res != None:
-                (jd,) = res
-                execute(cur, process_single(triple,job_link,jd))
-                print(f'[{job_link}] updated [{fld}]')
-
-def process_all(conn):
-    flag = False
-    for triple in get_fields(conn):
-        fld = triple[0]
-        with conn.cursor() as cur:
-            cur.execute(f"SELECT COUNT(*) FROM jobs WHERE {fld} IS NULL AND (ai_fail !~ '(?<![a-z_]){fld}(?![a-z_])')")
-            total = cur.fetchone()[0]
-        if total == 0:
-            continue
-        print(f'[[[[{fld}]]]]')
-        with tqdm(total=total) as pbar:
-            while True:
-                with conn.cursor() as cur:
-                    cur.execute(f"SELECT job_link,job_description FROM jobs WHERE {fld} IS NULL AND (ai_fail !~ '(?<![a-z_]){fld}(?![a-z_])') LIMIT 10")
-                    updates = [process_single(triple,jl,jd) for jl,jd in cur]
-                    if len(updates) == 0:
-                        break
-                    flag = True
-                    for u in updates:
-                        execute(cur, u)
-                pbar.update(len(updates))
+# Statements sharing the same SQL are sent together with executemany, which
+# psycopg runs in pipeline mode.
+def execute_many(cur, objs):
+    groups = {}
+    for sql,params in objs:
+        groups.setdefault(sql, []).append(params)
+    for sql,params in groups.items():
+        if dry_run:
+            print(f'cur.executemany({sql!r}, {params})')
+        else:
+            cur.executemany(sql, params)
 
-with psycopg.connect(sys.argv[2], autocommit=True) as conn:
-    if sys.argv[1] not in ['process','monitor']:
-        process_one(conn, sys.argv[1])
+# Jobs with outstanding questions are queued in ai_pending.  Finding them
+# scans jobs once per pass; workers then claim leases on the small queue
+# table, so several llm.py processes never answer the same job twice and a
+# crashed worker's jobs come back once its lease expires.
+def enqueue(conn,fields,links=None):
+    cond = ' OR '.join(pending(t[0]) for t in fields)
+    if links is None:
+        conn.execute(f"INSERT INTO ai_pending (job_link) SELECT job_link FROM jobs WHERE {cond} ON CONFLICT DO NOTHING")
     else:
-        while process_all(conn):
+        conn.execute(f"INSERT INTO ai_pending (job_link) SELECT job_link FROM jobs WHERE job_link = ANY(%s) AND ({cond}) ON CONFLICT DO NOTHING", (links,))
+
+def claim(conn,limit,job_link=None):
+    with conn.cursor() as cur:
+        cur.execute(f"""
+UPDATE ai_pending SET lease = now() + make_interval(secs => %s)
+WHERE job_link IN (
+  SELECT job_link FROM ai_pending
+  WHERE lease < now(){' AND job_link = %s' if job_link is not None else ''}
+  ORDER BY lease LIMIT %s FOR UPDATE SKIP LOCKED)
+RETURNING job_link;""", (lease,) + ((job_link,) if job_link is not None else ()) + (limit,))
+        return [jl for jl, in cur]
+
+# Claimed jobs can wait in the pipeline queues for a while before they reach
+# the model, so their leases are extended again at that point.  Returns the
+# number of leases that were still held.
+def renew(conn,links):
+    with conn.cursor() as cur:
+        cur.execute("UPDATE ai_pending SET lease = now() + make_interval(secs => %s) WHERE job_link = ANY(%s) AND lease > now() RETURNING job_link", (lease,links))
+        return len(cur.fetchall())
+
+# Dry runs page through the pending jobs in job_link order instead of
+# claiming them, so that they hold no leases.
+def peek(conn,fields,limit,after='',links=None):
+    cond = ' OR '.join(pending(t[0]) for t in fields)
+    with conn.cursor() as cur:
+        cur.execute(f"""
+SELECT job_link FROM jobs
+WHERE ({cond}) AND job_link > %s{' AND job_link = ANY(%s)' if links is not None else ''}
+ORDER BY job_link LIMIT %s""", (after,) + ((links,) if links is not None else ()) + (limit,))
+        return [jl for jl, in cur]
+
+# Returns the pending items and the jobs they belong to, see clean.
+def fetch(cur,fields,links):
+    cur.execute(f"""
+SELECT j.job_link, j.job_description, j.organization_name, t.text, {','.join(pending(t[0]) for t in fields)}
+FROM jobs j LEFT JOIN ai_text t ON t.job_link = j.job_link AND t.budget = %s AND t.cleaner = %s
+WHERE j.job_link = ANY(%s)""", (max_tokens,cleaner,links))
+    rows = cur.fetchall()
+    items = [(t,jl,jd) for jl,jd,_,_,*ps in rows for t,p in zip(fields,ps) if p]
+    return items,{jl: (jd,org,text) for jl,jd,org,text,*_ in rows}
+
+def finish(links):
+    return "DELETE FROM ai_pending WHERE job_link = ANY(%s)", (links,)
+
+def process_one(conn,job_link):
+    fields = get_fields(conn)
+    if not fields:
+        return
+    if dry_run:
+        links = peek(conn,fields,1,links=[job_link])
+    else:
+        enqueue(conn,fields,[job_link])
+        links = claim(conn,1,job_link)
+    if not links:
+        return
+    with conn.cursor() as cur:
+        items,jobs = fetch(cur,fields,links)
+        for u in process_batch(cur,items,jobs):
+            execute(cur, u)
+        execute(cur, finish(links))
+    print(f'[{job_link}] updated [{",".join(t[0] for t,_,_ in items)}]')
+
+timings = {}
+
+@contextlib.contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        t = timings.setdefault(stage, [0.0, 0])
+        t[0] += time.perf_counter() - start
+        t[1] += 1
+
+def put(q,item,stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+def get(q,stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=1)
+        except queue.Empty:
             pass
-        if sys.argv[1] == 'monitor':
-            print('\n\n')
-            print('Listening on <jobs> ...')
+
+def spawn(body,stop,errors):
+    def target():
+        try:
+            body()
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+    t = threading.Thread(target=target, daemon=True)
+    t.start()
+    return t
+
+# process_all runs as a pipeline of four stages connected by bounded queues:
+# a prefetch thread claims jobs, looks up the cache and cleans the HTML on its
+# own connection, a tokenizer thread trims the texts and encodes the prompts
+# (the fast tokenizer parallelizes a batch internally), the main thread keeps
+# the model busy, and a write-behind thread flushes the updates in bulk on
+# another connection.  Each None marks the end of a stream.  Without links,
+# every job is checked for pending work.
+def process_all(conn,links=None,fields=None):
+    if fields is None:
+        fields = get_fields(conn)
+    if not fields:
+        return
+    with conn.cursor() as cur:
+        if dry_run:
+            cond = ' OR '.join(pending(t[0]) for t in fields)
+            if links is None:
+                cur.execute(f"SELECT COUNT(*) FROM jobs WHERE {cond}")
+            else:
+                cur.execute(f"SELECT COUNT(*) FROM jobs WHERE job_link = ANY(%s) AND ({cond})", (links,))
+        else:
+            enqueue(conn,fields,links)
+            cur.execute("SELECT COUNT(*) FROM ai_pending WHERE lease < now()")
+        total = cur.fetchone()[0]
+    if total == 0:
+        return
+    if use_cache and links is None:
+        invalidate_cache(conn,fields)
+    print(f'[[[[{len(fields)} fields]]]]')
+
+    fetched = queue.Queue(queue_depth)
+    encoded = queue.Queue(queue_depth)
+    done = queue.Queue(queue_depth)
+    stop = threading.Event()
+    errors = []
+
+    def prefetch():
+        after = ''
+        with connect() as conn, conn.cursor() as cur:
+            while not stop.is_set():
+                with timed('prefetch'):
+                    if dry_run:
+                        claimed = peek(conn,fields,fetch_size,after,links)
+                    else:
+                        claimed = claim(conn,fetch_size)
+                    if len(claimed) == 0:
+                        break
+                    after = claimed[-1]
+                    items,jobs = fetch(cur,fields,claimed)
+                    keys,answers,todo = lookup(cur,items)
+                    misses = [items[v[0]] for v in todo.values()]
+                    texts,updates = clean(cur,jobs,misses)
+                put(fetched, (claimed,items,jobs,keys,answers,todo,misses,texts,updates), stop)
+        put(fetched, None, stop)
+
+    def tokenize():
+        while (batch := get(fetched,stop)) is not None:
+            links,items,jobs,keys,answers,todo,misses,texts,updates = batch
+            with timed('tokenize'):
+                updates += trim(texts,jobs)
+                ids = encode(misses,with_stored(texts,jobs))
+            put(encoded, (links,items,keys,answers,todo,misses,ids,updates), stop)
+        put(encoded, None, stop)
+
+    def write():
+        with connect() as conn, conn.cursor() as cur:
+            while (batch := done.get()) is not None:
+                links,updates = batch
+                with timed('write'):
+                    execute_many(cur, updates)
+                    execute(cur, finish(links))
+
+    threads = [spawn(prefetch,stop,errors), spawn(tokenize,stop,errors)]
+    writer = spawn(write,stop,errors)
+    try:
+        with tqdm(total=total) as pbar:
+            while (batch := get(encoded,stop)) is not None:
+                links,items,keys,answers,todo,misses,ids,updates = batch
+                if not dry_run and (held := renew(conn,links)) < len(links):
+                    print(f'{len(links) - held} leases expired before inference; raise LLM_LEASE or lower LLM_QUEUE_DEPTH')
+                with timed('model'):
+                    for k,a in zip(todo, answer_encoded(misses,ids)):
+                        answers[k] = a
+                put(done, (links,updates + collect(items,keys,answers,todo)), stop)
+                pbar.update(len(links))
+                pbar.set_postfix(**progress())
+    finally:
+        # The writer drains what is already done even when another stage
+        # failed and set stop; only a dead writer stops waiting for the end.
+        while writer.is_alive():
+            try:
+                done.put(None, timeout=1)
+                break
+            except queue.Full:
+                pass
+        writer.join()
+        stop.set()
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+
+# Dry runs create nothing, so they need the tables of an earlier real run.
+def setup(conn):
+    if dry_run:
+        needed = ['ai_text', 'ai_text_blocks'] + (['ai_cache'] if use_cache else [])
+        missing = [t for t in needed if conn.execute("SELECT to_regclass(%s)", (t,)).fetchone()[0] is None]
+        if missing:
+            print(f'Missing {", ".join(missing)}; run once without -n to create them')
+            sys.exit(1)
+        return
+    conn.execute("CREATE TABLE IF NOT EXISTS ai_pending (job_link text PRIMARY KEY, lease timestamptz NOT NULL DEFAULT '-infinity')")
+    conn.execute("CREATE INDEX IF NOT EXISTS ai_pending_lease ON ai_pending (lease)")
+    if store_confidence:
+        conn.execute("CREATE TABLE IF NOT EXISTS ai_confidence (job_link text, fld name, p real, PRIMARY KEY (job_link, fld))")
+    conn.execute("CREATE TABLE IF NOT EXISTS ai_text (job_link text PRIMARY KEY, budget integer NOT NULL, text text NOT NULL, raw_tokens integer NOT NULL, tokens integer NOT NULL)")
+    conn.execute("ALTER TABLE ai_text ADD COLUMN IF NOT EXISTS cleaner smallint NOT NULL DEFAULT 1")
+    conn.execute("CREATE TABLE IF NOT EXISTS ai_text_blocks (hash bytea, org text, PRIMARY KEY (hash, org))")
+    if use_cache:
+        conn.execute("CREATE TABLE IF NOT EXISTS ai_cache (key bytea PRIMARY KEY, fld name NOT NULL, cmt_hash bytea NOT NULL, answer smallint NOT NULL, p real)")
+        conn.execute("CREATE INDEX IF NOT EXISTS ai_cache_fld ON ai_cache (fld)")
+
+# A listener thread collects the notified job_links on its own connection,
+# so nothing is lost while a batch is running.  The main thread waits for
+# window seconds after the first notification, then runs every distinct
+# job_link received so far through process_all.  The field catalog is a
+# single catalog query, so it is reread before every batch; stale cache
+# entries are dropped only when it actually changed.
+def monitor(conn):
+    links = set()
+    lock = threading.Lock()
+    wake = threading.Event()
+    listening = threading.Event()
+
+    def listen():
+        with connect() as conn:
             conn.execute('LISTEN jobs')
+            listening.set()
             for notify in conn.notifies():
-                print(notify)
                 if notify.payload != '':
-                    process_one(conn,notify.payload)
+                    with lock:
+                        links.add(notify.payload)
+                    wake.set()
+
+    listener = threading.Thread(target=listen, daemon=True)
+    listener.start()
+    while not listening.wait(1):
+        if not listener.is_alive():
+            sys.exit(3)
+    process_all(conn)
+    print('\n\n')
+    print('Listening on <jobs> ...')
+    fields = get_fields(conn)
+    while True:
+        if not wake.wait(60):
+            if not listener.is_alive():
+                print('Listener connection lost')
+                sys.exit(3)
+            continue
+        time.sleep(window)
+        wake.clear()
+        with lock:
+            batch = list(links)
+            links.clear()
+        refreshed = get_fields(conn)
+        if refreshed != fields and use_cache:
+            invalidate_cache(conn,refreshed)
+        fields = refreshed
+        print(f'[{len(batch)} notified]')
+        process_all(conn,batch,fields)
+
+# Serves the LLM_BACKEND model to any number of llm.py processes.  Requests from several
+# clients are run one at a time; OOM splitting is left to the clients.
+def serve(addr):
+    if not authkey:
+        print('Set LLM_AUTHKEY to a secret shared with the clients')
+        sys.exit(1)
+    try:
+        address = parse_address(addr)
+    except ValueError as e:
+        print(f'Refusing to serve on {addr}: {e}')
+        sys.exit(1)
+    if isinstance(address, str) and os.path.exists(address):
+        os.unlink(address)
+    backend.get_model()
+    lock = threading.Lock()
+
+    def handle(conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    return
+                try:
+                    if request[0] == 'info':
+                        res = True,(backend.name,backend.model_name)
+                    else:
+                        _,mode,input_ids = request
+                        with lock:
+                            res = True,backend.run(mode,input_ids)
+                except Exception as e:
+                    if isinstance(e, torch.cuda.OutOfMemoryError):
+                        torch.cuda.empty_cache()
+                    res = False,e
+                try:
+                    conn.send(res)
+                except Exception as e:
+                    conn.send((False,RuntimeError(repr(res[1]))))
+
+    with Listener(address, authkey=authkey) as listener:
+        if isinstance(address, str):
+            os.chmod(address, 0o600)
+        print(f'Serving {backend.name} on {addr} ...')
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, AuthenticationError) as e:
+                print(e)
+                continue
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+BENCH_FIELDS = [
+    ('ai_remote', 'boolean', 'Is this job fully remote? Answer yes or no.'),
+    ('ai_degree', 'boolean', 'Does this job require a graduate degree? Answer yes or no.'),
+    ('ai_travel', 'boolean', 'Does this job involve frequent travel? Answer yes or no.'),
+    ('ai_sw', 'smallint', 'On a scale of 0 to 10, how much of this job is software development?'),
+    ('ai_hw', 'smallint', 'On a scale of 0 to 10, how much of this job is hardware design?'),
+    ('ai_years', 'smallint', 'How many years of experience does this job require?'),
+]
+BENCH_WORDS = ('design build test verify deploy maintain firmware software hardware circuit '
+               'system cloud team customer product research analysis model data pipeline '
+               'embedded silicon board driver kernel compiler python rust verilog').split()
+BENCH_BOILERPLATE = ('<p>We are an equal opportunity employer and all qualified applicants will '
+                     'receive consideration for employment without regard to race, color, religion, '
+                     'sex, national origin, disability or veteran status.</p>'
+                     '<p>We offer medical, dental and vision insurance, a 401(k) match and paid time off.</p>')
+
+def synthetic_jobs(n,rng):
+    jobs = []
+    for i in range(n):
+        if jobs and rng.random() < 0.2:
+            _,html,org = rng.choice(jobs)
+        else:
+            paragraphs = [' '.join(rng.choice(BENCH_WORDS) for _ in range(rng.randint(20,120)))
+                          for _ in range(rng.randint(2,8))]
+            items = ''.join(f'<li>{rng.choice(BENCH_WORDS)} {rng.choice(BENCH_WORDS)}</li>' for _ in range(rng.randint(3,10)))
+            html = ''.join(f'<p>{p}</p>' for p in paragraphs) + f'<ul>{items}</ul>' + BENCH_BOILERPLATE
+            org = f'org{rng.randrange(50)}'
+        jobs.append((f'https://bench.invalid/jobs/view/{i}',html,org))
+    return jobs
+
+# Runs process_all over LLM_BENCH_JOBS synthetic jobs (a fifth of them
+# reposts) in a scratch jb_bench schema, then reports the throughput and the
+# time spent in each pipeline stage.  Set LLM_BENCH_KEEP to keep the schema.
+def bench():
+    n = int(os.environ.get('LLM_BENCH_JOBS', '1000'))
+    with connect() as conn:
+        conn.execute("DROP SCHEMA IF EXISTS jb_bench CASCADE")
+        conn.execute("CREATE SCHEMA jb_bench")
+    connect_args['options'] = '-c search_path=jb_bench'
+    try:
+        with connect() as conn:
+            conn.execute(f"""
+CREATE TABLE jobs (job_link text PRIMARY KEY, job_description text, organization_name text,
+  ai_fail text NOT NULL DEFAULT '', mtime timestamptz, {', '.join(f'{fld} {ty}' for fld,ty,_ in BENCH_FIELDS)})""")
+            for fld,_,cmt in BENCH_FIELDS:
+                conn.execute(sql.SQL("COMMENT ON COLUMN jobs.{} IS {}").format(sql.Identifier(fld), sql.Literal(cmt)))
+            with conn.cursor() as cur:
+                cur.executemany("INSERT INTO jobs (job_link, job_description, organization_name) VALUES (%s, %s, %s)",
+                    synthetic_jobs(n, random.Random(0)))
+            setup(conn)
+            start = time.perf_counter()
+            process_all(conn)
+            elapsed = time.perf_counter() - start
+    finally:
+        del connect_args['options']
+        if os.environ.get('LLM_BENCH_KEEP', '') == '':
+            with connect() as conn:
+                conn.execute("DROP SCHEMA jb_bench CASCADE")
+    print(f'{n} jobs in {elapsed:.1f}s: {n / elapsed:.2f} jobs/s on {backend.name}')
+    print(', '.join(f'{k}={v}' for k,v in progress().items()))
+    for stage,(total,count) in timings.items():
+        print(f'{stage:>10}: {count:6} batches {total:8.2f}s {1000 * total / max(1, count):8.1f}ms/batch')
+
+connect_args = {}
+
+def connect():
+    return psycopg.connect(sys.argv[2], autocommit=True, **connect_args)
+
+if sys.argv[1] == 'serve':
+    serve(sys.argv[2])
+    sys.exit(0)
+
+if sys.argv[1] == 'bench':
+    bench()
+    sys.exit(0)
+
+with connect() as conn:
+    setup(conn)
+    if sys.argv[1] == 'monitor':
+        monitor(conn)
+    elif sys.argv[1] == 'process':
+        while process_all(conn):
+            pass
+    else:
+        process_one(conn, sys.argv[1])